@@ -101,13 +101,13 @@ class PalBot(PalDelegate):
                     self.sendPrivate(self.owner, 'Already subscribed to %s (%s).' % (name, gid))
                 else:
                     self.sendPrivate(self.owner, 'Joining %s...' % data)
-                    self.protocol.sendPacket(PalPacket.group_join(data))
+                    self.protocol.queuePacket(PalPacket.group_join(data))
                 return True
             elif cmd.lower() == 'l':
                 name, gid = self.findGroup(data)
                 if name and gid:
                     self.sendPrivate(self.owner, 'Leaving %s (%s)...' % (name, gid))
-                    mesgId = self.protocol.sendPacket(PalPacket.group_leave(gid))
+                    mesgId = self.protocol.queuePacket(PalPacket.group_leave(gid))
                     self.responses[str(mesgId)] = self.removeGroup(gid)
                 else:
                     self.sendPrivate(self.owner, 'Not subscribed to %s.' % data)
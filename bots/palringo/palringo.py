@@ -4,15 +4,19 @@
 # Palringo connectivity and protocol
 # Copyright (c) 2012 Mark Jundo P Documento
 
+from collections import deque, OrderedDict
 from hashlib import md5
 from operator import itemgetter
 from salsa20 import Salsa20
 from sys import stdout
 from struct import unpack
-from twisted.internet import reactor, ssl, task
-from twisted.internet.protocol import Protocol, ReconnectingClientFactory
+from twisted.internet import reactor, ssl
+from twisted.internet.protocol import ProcessProtocol, Protocol, ReconnectingClientFactory
 
-import time, traceback, zlib
+import os, sys, time, traceback, zlib
+
+HOST = 'primary.palringo.com'
+PORT = 12345
 
 
 class PalDelegate:
@@ -53,11 +57,67 @@ class PalDelegate:
         return 0
 
 
-class PalPacket:
+class Headers(dict):
+    # Header names keep the case they were given in, for toData, and
+    # are also looked up by lower case name. Setting a name that is
+    # already there in another case replaces its value; deleting
+    # and popping resolve the name the same way.
+    __slots__ = ('names',)
+
+    def __init__(self, headers=None):
+        dict.__init__(self)
+        self.names = {}
+        if headers:
+            self.update(headers)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, self.names.setdefault(key.lower(), key), value)
+
+    def __delitem__(self, key):
+        if key.lower() not in self.names:
+            raise KeyError(key)
+        dict.__delitem__(self, self.names.pop(key.lower()))
+
+    def pop(self, key, *default):
+        if key.lower() not in self.names:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return dict.pop(self, self.names.pop(key.lower()))
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        del self.names[key.lower()]
+        return key, value
+
+    def setdefault(self, key, value=None):
+        if key.lower() not in self.names:
+            self[key] = value
+        return dict.__getitem__(self, self.names[key.lower()])
+
+    def clear(self):
+        dict.clear(self)
+        self.names.clear()
+
+    def copy(self):
+        return Headers(self)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).iteritems():
+            self[k] = v
+
+    def lookup(self, key):
+        name = self.names.get(key.lower())
+        return None if name is None else dict.__getitem__(self, name)
+
+
+
+class PalPacket(object):
     NULL_HEADER = 'no-header'
+    __slots__ = ('command', 'payload', 'headers', 'needsMid', '__compressed')
 
-    def __init__(self, command, payload='', headers={}, needsMid=False):
-        self.command, self.payload, self.headers, self.needsMid = command, payload, headers, needsMid
+    def __init__(self, command, payload='', headers=None, needsMid=False):
+        self.command, self.payload, self.headers, self.needsMid = command, payload, Headers(headers), needsMid
         self.__compressed = False
 
     def isCompressed(self):
@@ -67,29 +127,16 @@ class PalPacket:
         return len(self.payload)
 
     def hasKeyI(self, key):
-        for k, v in self.headers.iteritems():
-            if key.lower() == k.lower():
-                return True
-        return False
+        return key.lower() in self.headers.names
 
     def hasValueI(self, key, value):
-        for k, v in self.headers.iteritems():
-            if key.lower() == k.lower():
-                return value == v
-        return False
+        return self.hasKeyI(key) and self.headers.lookup(key) == value
 
     def setValueI(self, key, value):
-        for k, v in self.headers.iteritems():
-            if key.lower() == k.lower():
-                key = k
-                break
         self.headers[key] = value
 
     def getValueI(self, key):
-        for k, v in self.headers.iteritems():
-            if key.lower() == k.lower():
-                return v
-        return None
+        return self.headers.lookup(key)
 
     def getValue(self, key):
         if key in self.headers:
@@ -126,28 +173,44 @@ class PalPacket:
             self.__compressed = False
 
     @staticmethod
-    def parse(data, decompress=False):
+    def headerEnd(data, start=0):
+        # (position, delimiter) of the blank line ending the headers
+        crlf = data.find('\r\n\r\n', start)
+        lf = data.find('\n\n', start)
+        if crlf < 0 and lf < 0:
+            return None
+        if lf < 0 or 0 <= crlf < lf:
+            return crlf, '\r\n'
+        return lf, '\n'
+
+    @staticmethod
+    def parseHeader(header, delim):
         try:
-            try:
-                plpos = data.index('\r\n\r\n')
-                delim = '\r\n'
-            except ValueError:
-                plpos = data.index('\n\n')
-                delim = '\n'
-            split = data[:plpos].split(delim)
+            split = header.split(delim)
             cmd = split[0]
-            headers = dict([kv.split(': ') for kv in split[1:]])
-            payload = data[plpos + len(delim)*2:]
-            p = PalPacket(cmd, payload=payload, headers=headers)
+            headers = dict([kv.split(': ', 1) for kv in split[1:]])
+            p = PalPacket(cmd, headers=headers)
             if p.hasValueI('compression', '1'):
                 p.__compressed = True
-                if decompress:
-                    p.decomp()
             return p
         except ValueError as e:
             traceback.print_exc()
+            print 'Malformed packet?', header.encode('hex')
+            return None
+
+    @staticmethod
+    def parse(data, decompress=False):
+        end = PalPacket.headerEnd(data)
+        if end is None:
             print 'Malformed packet?', data.encode('hex')
             return None
+        plpos, delim = end
+        p = PalPacket.parseHeader(data[:plpos], delim)
+        if p is not None:
+            p.payload = data[plpos + len(delim)*2:]
+            if decompress:
+                p.decompress()
+        return p
 
     @staticmethod
     def logon(email, redirect_count=0):
@@ -297,7 +360,9 @@ class PalPacket:
 
 
 
-class Mesg:
+class Mesg(object):
+    __slots__ = ('sourceId', 'name', 'totalLength', 'mime', 'chunks', 'groupId')
+
     def __init__(self, sourceId, name, mesgId, totalLength, msg, mime):
         self.sourceId, self.name, self.totalLength, self.mime = sourceId, name, totalLength, mime
         self.chunks = {mesgId : (-1, msg)}
@@ -327,11 +392,84 @@ class Mesg:
 
 
 
+class Outbox:
+    # Token bucket: up to burst packets at once, then rate per second.
+    # Control packets (pings, auth, groups) go before any chat, and
+    # chat is sent round robin over its targets so one long reply
+    # does not hold up every other group.
+    CONTROL, CHAT = 0, 1
+
+    def __init__(self, send, rate, burst, clock=reactor):
+        self.send, self.rate, self.burst, self.clock = send, rate, burst, clock
+        self.tokens = float(burst)
+        self.stamp = clock.seconds()
+        self.control = deque()
+        self.chat = OrderedDict()
+        self.depth = 0
+        self.peak = 0
+        self.sent = 0
+        self.call = None
+
+    def push(self, packet, lane=CHAT, target=None):
+        if lane == Outbox.CONTROL:
+            self.control.append(packet)
+        else:
+            self.chat.setdefault(target, deque()).append(packet)
+        self.depth += 1
+        self.peak = max(self.peak, self.depth)
+        self.pump()
+
+    def pop(self):
+        if self.control:
+            return self.control.popleft()
+        target, queue = self.chat.popitem(last=False)
+        packet = queue.popleft()
+        if queue:
+            self.chat[target] = queue
+        return packet
+
+    def pump(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        while self.depth and self.tokens > 1 - 1e-9:
+            self.tokens -= 1
+            self.depth -= 1
+            self.sent += 1
+            self.send(self.pop())
+        if self.depth and self.call is None:
+            self.call = self.clock.callLater((1 - self.tokens) / self.rate, self.wake)
+
+    def wake(self):
+        self.call = None
+        self.pump()
+
+    def stop(self):
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+        self.control.clear()
+        self.chat.clear()
+        self.depth = 0
+
+    def stats(self):
+        return {'control': len(self.control),
+                'chat': self.depth - len(self.control),
+                'targets': len(self.chat),
+                'peak': self.peak,
+                'sent': self.sent}
+
+
+
 class PalProtocol(Protocol):
     DEBUG = True
+    RATE = 4.0
+    BURST = 8
 
     def __init__(self, factory, login, password, delegate=None, autoDecompress=False):
         self.factory, self.login, self.password, self.delegate, self.autoDecompress = factory, login, password, delegate, autoDecompress
+        self.buffer = bytearray()
+        self.offset = 0
         self.packet = None
         self.mesg = None
         self.clen = 0
@@ -345,36 +483,34 @@ class PalProtocol(Protocol):
             'RESPONSE':self.doResponse,
             'SUB PROFILE':self.doSubProfile,
         }
-        self.outbox = []
-        self.looper = None
+        self.outbox = Outbox(self.sendPacket,
+                             getattr(factory, 'rate', self.RATE),
+                             getattr(factory, 'burst', self.BURST))
 
     def connectionMade(self):
         print 'Sending logon'
-        redirect_count = 0 if not self.delegate else self.delegate.redirectCount()
+        redirect_count = max(self.factory.redirects,
+                             0 if not self.delegate else self.delegate.redirectCount())
         self.sendPacket(PalPacket.logon(self.login, redirect_count=redirect_count))
         self.pings = 0
         self.mesgId = 1
         if self.delegate:
             self.delegate.onProtocolConnected(self)
-        self.looper = task.LoopingCall(self.sendFromOutbox)
-        self.looper.start(1, now=True)
-
-    def sendFromOutbox(self):
-        if self.outbox:
-            self.sendPacket(self.outbox[0])
-            del self.outbox[0]
 
     def connectionLost(self, reason):
-        if self.looper:
-            self.looper.stop()
-            self.looper = None
+        self.outbox.stop()
 
     def dataReceived(self, data):
-        packet = self.parseData(data)
-        if packet is not None:
+        self.buffer.extend(data)
+        while True:
+            packet = self.parseData()
+            if packet is None:
+                break
             if PalProtocol.DEBUG:
                 print 'Recv:', packet
             self.parsePacket(packet)
+        del self.buffer[:self.offset]
+        self.offset = 0
 
     def sendPacket(self, packet):
         mesgId = None
@@ -387,6 +523,16 @@ class PalProtocol(Protocol):
         self.transport.write(packet.toData())
         return mesgId
 
+    def queuePacket(self, packet, lane=Outbox.CONTROL, target=None):
+        mesgId = None
+        if packet.needsMid:
+            mesgId = self.mesgId
+            packet.setValueI('mesg-id', mesgId)
+            packet.needsMid = False
+            self.mesgId += 1
+        self.outbox.push(packet, lane, target)
+        return mesgId
+
     def sendMesg(self, target, to, payload, mime=None):
         ofs = 0
         correlationId=None
@@ -405,39 +551,46 @@ class PalProtocol(Protocol):
             p.setValueI('Mesg-Id', self.mesgId)
             correlationId = self.mesgId
             self.mesgId += 1
-            self.outbox.append(p)
+            self.outbox.push(p, Outbox.CHAT, to)
         return self.mesgId - 1
 
-    def parseData(self, data):
-        if self.packet is None:
-            p = PalPacket.parse(data, self.autoDecompress)
-            if p is None: return
-            l = p.getValueI('content-length')
-            if l is None or len(p.payload) == int(l):
-                return p
-            else:
-                self.packet = p
-                self.clen = int(l)
-                if PalProtocol.DEBUG:
-                    print 'Got', len(p.payload), 'bytes payload. Waiting for', l
-                return None
-        else:
-            self.packet.payload += data
-            if len(self.packet.payload) >= self.clen:
-                p = self.packet
-                p.payload = p.payload[:self.clen]
-                self.packet = None
-                self.clen = 0
-                return p
-            else:
+    def parseData(self):
+        # Next complete packet in the receive buffer, None if there is
+        # only part of one. Used bytes are skipped with self.offset and
+        # dropped by dataReceived once per read.
+        while self.packet is None:
+            end = PalPacket.headerEnd(self.buffer, self.offset)
+            if end is None:
                 return None
+            plpos, delim = end
+            header = str(self.buffer[self.offset:plpos])
+            self.offset = plpos + len(delim)*2
+            self.packet = PalPacket.parseHeader(header, delim)
+            if self.packet is not None:
+                try:
+                    self.clen = int(self.packet.getValueI('content-length') or 0)
+                except ValueError:
+                    print 'Malformed packet?', header.encode('hex')
+                    self.packet = None
+        if len(self.buffer) - self.offset < self.clen:
+            if PalProtocol.DEBUG:
+                print 'Got', len(self.buffer) - self.offset, 'bytes payload. Waiting for', self.clen
+            return None
+        p = self.packet
+        p.payload = str(self.buffer[self.offset:self.offset + self.clen])
+        self.offset += self.clen
+        self.packet = None
+        self.clen = 0
+        if self.autoDecompress:
+            p.decompress()
+        return p
 
     def parsePacket(self, packet):
         if packet.command in self.commands:
             self.commands[packet.command](packet)
  
     def doAuth(self, packet):
-        self.sendPacket(PalPacket.auth(self.password, packet))
+        self.queuePacket(PalPacket.auth(self.password, packet))
         if self.delegate:
             self.delegate.onAuth(packet)
 
@@ -456,6 +609,7 @@ class PalProtocol(Protocol):
         if packet.hasValueI('reason', '32'):
             print 'Changing host from ', self.factory.host, 'to', packet.payload
             self.factory.host = packet.payload
+            self.factory.redirects += 1
         if self.delegate:
             self.delegate.onLogonFailed(packet)
 
@@ -507,7 +661,7 @@ class PalProtocol(Protocol):
                 self.delegate.onPrivateMesg(mesg)
 
     def doPing(self, packet):
-        self.sendPacket(PalPacket.ping(self.pings))
+        self.queuePacket(PalPacket.ping(self.pings))
         self.pings += 1
 
     def doSubProfile(self, packet):
@@ -558,18 +712,25 @@ class PalClientFactory(ReconnectingClientFactory):
     def __init__(self, login, password, protocol=PalProtocol, delegate=None):
         self.login, self.password, self.protocol, self.delegate = login, password, protocol, delegate
         self.host = None
+        self.redirects = 0
+        self.rate, self.burst = protocol.RATE, protocol.BURST
+        self.current = None
+        self.connecting = None
         
     def startedConnecting(self, connector):
         print 'Started to connect.'
+        self.connector = connector
 
     def buildProtocol(self, addr):
         print 'Connected.'
         print 'Resetting reconnection delay'
         self.resetDelay()
-        return self.protocol(self, self.login, self.password, delegate=self.delegate)
+        self.current = self.protocol(self, self.login, self.password, delegate=self.delegate)
+        return self.current
 
     def clientConnectionLost(self, connector, reason):
         print 'Lost connection.  Reason:', reason
+        self.current = None
         if self.host is not None:
             connector.host = self.host
         ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
@@ -581,13 +742,91 @@ class PalClientFactory(ReconnectingClientFactory):
 
 
 
+class PalSessions:
+    # Many accounts in one reactor. Every account gets its own
+    # PalClientFactory with the same outbox rate and burst and the
+    # same reconnect backoff, follows its own redirects, and is
+    # connected STAGGER seconds after the one before it so that a
+    # restart does not log on every account at once. Removing an
+    # account cancels its connection if it has not started yet.
+    STAGGER = 0.5
+
+    def __init__(self, host=HOST, port=PORT, protocol=PalProtocol, rate=None, burst=None,
+                 initialDelay=1.0, maxDelay=300, factor=2.0):
+        self.host, self.port, self.protocol = host, port, protocol
+        self.rate = protocol.RATE if rate is None else rate
+        self.burst = protocol.BURST if burst is None else burst
+        self.initialDelay, self.maxDelay, self.factor = initialDelay, maxDelay, factor
+        self.factories = OrderedDict()
+        self.connectAt = -self.STAGGER
+
+    def add(self, login, password, delegate=None):
+        factory = PalClientFactory(login, password, protocol=self.protocol, delegate=delegate)
+        factory.rate, factory.burst = self.rate, self.burst
+        factory.initialDelay, factory.maxDelay, factory.factor = self.initialDelay, self.maxDelay, self.factor
+        factory.delay = self.initialDelay
+        self.factories[login] = factory
+        now = reactor.seconds()
+        self.connectAt = max(now, self.connectAt + self.STAGGER)
+        factory.connecting = reactor.callLater(self.connectAt - now, reactor.connectTCP, self.host, self.port, factory)
+        return factory
+
+    def remove(self, login):
+        factory = self.factories.pop(login)
+        if factory.connecting is not None and factory.connecting.active():
+            factory.connecting.cancel()
+        factory.stopTrying()
+        if factory.current is not None:
+            factory.current.transport.loseConnection()
+
+    def stats(self):
+        return dict((login, None if factory.current is None else factory.current.outbox.stats())
+                    for login, factory in self.factories.iteritems())
+
+
+
+class ShardProcess(ProcessProtocol):
+    running = 0
+
+    def connectionMade(self):
+        ShardProcess.running += 1
+
+    def processEnded(self, reason):
+        print 'Shard ended:', reason.value
+        ShardProcess.running -= 1
+        if not ShardProcess.running:
+            reactor.stop()
+
+
+
+def runSessions(accounts, makeDelegate=None, workers=1, **options):
+    # Runs accounts, a list of (login, password), in PalSessions. With
+    # workers > 1 the running script is started again that many times
+    # with PAL_SHARD set to "i/workers", and each copy runs every
+    # workers-th account from the i-th on, so accounts must be listed
+    # in the same order every time.
+    shard = os.environ.get('PAL_SHARD')
+    if workers > 1 and shard is None:
+        for i in range(workers):
+            env = dict(os.environ, PAL_SHARD='%d/%d' % (i, workers))
+            reactor.spawnProcess(ShardProcess(), sys.executable, [sys.executable] + sys.argv, env=env,
+                                 childFDs={0: 0, 1: 1, 2: 2})
+    else:
+        i, n = map(int, shard.split('/')) if shard else (0, 1)
+        sessions = PalSessions(**options)
+        for login, password in accounts[i::n]:
+            sessions.add(login, password, delegate=makeDelegate(login) if makeDelegate else None)
+    reactor.run()
+
+
+
 def palConnect(login, password, delegate=None, protocol=PalProtocol, ssl=False):
-    host = 'primary.palringo.com'
+    host = HOST
     if ssl:
         port = 443
         assert(False)
     else:
-        port = 12345
+        port = PORT
         reactor.connectTCP(host, port, PalClientFactory(login, password, delegate=delegate, protocol=protocol))
 
 
@@ -5,32 +5,37 @@
 # Palringo connectivity and protocol
 # Copyright (c) 2012 Mark Jundo P Documento
 
-import json, random, re, sys, threading, urllib, urllib2
-from twisted.web.client import getPage
+# Requests go through one Agent with a pool of persistent
+# connections. At most MAX_SIMSIMI are in flight at a time, up to
+# MAX_PENDING more wait for their turn and chat beyond that is
+# dropped. Each request is cancelled after TIMEOUT seconds. Set
+# SIMSIMI_URL to point the bot at a local stub server.
+
+import json, os, random, urllib
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredSemaphore
+from twisted.web import error
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
 from bot import PalBot
 
 AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/535.19 (KHTML, like Gecko) Ubuntu/12.04 Chromium/18.0.1025.168 Chrome/18.0.1025.168 Safari/535.19'
+URL = os.environ.get('SIMSIMI_URL', 'http://app.simsimi.com/app/aicr/request.p')
 
 MAX_SIMSIMI = 30
+MAX_PENDING = 100
 SIMSIMI_FILTERING = 0.0
+TIMEOUT = 10
 
 class SimsimiBot(PalBot):
-    def __init__(self, owner=None, useThreads=False):
+    def __init__(self, owner=None, url=URL):
         PalBot.__init__(self, 'Simsimi', owner=owner)
-        self.simsimi = 0
-        self.useThreads = useThreads
+        self.url = url
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = MAX_SIMSIMI
+        self.agent = Agent(reactor, pool=self.pool)
+        self.semaphore = DeferredSemaphore(MAX_SIMSIMI)
 
-    def run(self, msg, toId, name, pm):
-        acak = str(int(random.uniform(100000,300000)))
-        data = {'av': 5.2, 'ft': SIMSIMI_FILTERING, 'lc': 'ph', 'os': 'i', 'req': msg, 'tz': "Asia/Manila", 'uid': acak}
-        url = "http://app.simsimi.com/app/aicr/request.p?" + urllib.urlencode(data)
-        req = urllib2.Request(url, headers={'User-Agent': AGENT})
-        data = urllib2.urlopen(req).read()
-        o = json.loads(data)
-        res = o['sentence_resp']
-        self.postReply(res, toId, name, pm)
-        self.simsimi -= 1
-    
     def onPrivateMesg(self, mesg):
         if PalBot.onPrivateMesg(self, mesg): return True
         if mesg.mime != 'text/plain': return
@@ -52,34 +57,43 @@ class SimsimiBot(PalBot):
                 name = self.contacts()[uid]['Nickname']
             else:
                 name = ''
-            return self.processChat(msg, mesg.groupId, name, False)
+            return self.processChat(msg[1:], mesg.groupId, name, False)
         else:
             return False
 
     def processChat(self, msg, toId, name, pm):
         if len(msg) > 1:
-            if self.useThreads and self.simsimi < MAX_SIMSIMI:
-                self.simsimi += 1
-                t = threading.Thread(target=self.run, args=(msg, toId, name, pm))
-                t.start()
-            elif not self.useThreads:
-                self.runTwisted(msg, toId, name, pm)
+            if len(self.semaphore.waiting) >= MAX_PENDING:
+                print 'Simsimi busy, dropped:', msg
+                return False
+            d = self.semaphore.run(self.request, msg)
+            d.addCallback(self.postReply, toId, name, pm)
+            d.addErrback(self.gotError)
             return True
         else:
             return False
 
-    def runTwisted(self, msg, toId, name, pm):
+    def request(self, msg):
         acak = str(int(random.uniform(100000,300000)))
-        data = {'av': 5.2, 'ft': SIMSIMI_FILTERING, 'lc': 'ph', 'os': 'i', 'req': msg[1:], 'tz': "Asia/Manila", 'uid': acak}
-        url = "http://app.simsimi.com/app/aicr/request.p?" + urllib.urlencode(data)
-        return getPage(url, agent=AGENT).addCallback(self.gotSimi(toId, name, pm)).addErrback(self.gotError)
+        data = {'av': 5.2, 'ft': SIMSIMI_FILTERING, 'lc': 'ph', 'os': 'i', 'req': msg, 'tz': "Asia/Manila", 'uid': acak}
+        url = self.url + '?' + urllib.urlencode(data)
+        d = self.agent.request('GET', url, Headers({'User-Agent': [AGENT]}))
+        d.addCallback(self.gotResponse)
+        timeout = reactor.callLater(TIMEOUT, d.cancel)
+        def done(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+        return d.addBoth(done)
+
+    def gotResponse(self, response):
+        return readBody(response).addCallback(self.gotSimi, response.code)
 
-    def gotSimi(self, toId, name, pm):
-        def gotPage(data):
-            o = json.loads(data)
-            res = o['sentence_resp']
-            self.postReply(res, toId, name, pm)
-        return gotPage
+    def gotSimi(self, data, code):
+        if code != 200:
+            raise error.Error(code, data[:100])
+        o = json.loads(data)
+        return o['sentence_resp']
 
     def postReply(self, reply, toId, name, pm):
         try:
@@ -0,0 +1,131 @@
+# bench.py
+# Benchmark indexing and searching on a synthetic catalogue.
+#
+# Usage: bench.py [--songs n] [--queries n] [--jobs n] [--compact]
+#                 [--seed n] [--dir path] [--output file]
+#
+# Generates a catalogue of empty "Artist - Title [year].mp3" files
+# in a temporary directory (or in --dir, where an existing songs/
+# directory is reused). Artist and title words are drawn from a
+# vocabulary of pronounceable made-up words with Zipf distributed
+# frequencies (the n-th most common word is 1/n^ZIPF as frequent
+# as the first), as in real song names. Artists have several
+# songs each. Names drawn twice make one file, so throughput is
+# reported for the files actually on disk.
+#
+# The catalogue is indexed with index.py, once from scratch and
+# once more with nothing changed, and then QUERIES queries of 1 to
+# LONGEST terms, drawn from the same distribution, are searched
+# directly in songs.db (and in songs.idx with --compact). The
+# results are written as one JSON object: indexing times and
+# throughput, database size and p50/p99/mean latency in
+# milliseconds per query length.
+
+import argparse, json, os, random, shutil, statistics, subprocess, sys, tempfile, time
+
+from search import LIMIT, RANKING, connect, count, search
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SYLLABLES = [c + v for c in 'bdfghklmnprstvwz' for v in 'aeiou']
+ZIPF = 1.1
+LONGEST = 4
+
+def vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))))
+    return sorted(words, key=lambda w: rng.random())
+
+def zipf(words, rng):
+    weights, total = [], 0.0
+    for rank in range(1, len(words) + 1):
+        total += 1 / rank**ZIPF
+        weights.append(total)
+    def draw(k):
+        return rng.choices(words, cum_weights=weights, k=k)
+    return draw
+
+def generate(path, songs, rng):
+    draw = zipf(vocabulary(max(1000, songs // 10), rng), rng)
+    os.makedirs(path)
+    artists = [' '.join(draw(rng.randint(1, 3))).title() for _ in range(max(1, songs // 8))]
+    for i in range(songs):
+        name = '{} - {} [{}].mp3'.format(rng.choice(artists), ' '.join(draw(rng.randint(1, 5))).title(),
+                                        rng.randint(1950, 2017))
+        open(os.path.join(path, name), 'w').close()
+    return draw
+
+def at_least(n):
+    def check(value):
+        value = int(value)
+        if value < n:
+            raise argparse.ArgumentTypeError('must be at least {}'.format(n))
+        return value
+    return check
+
+def index(path, *args):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(HERE, 'index.py')] + list(args),
+                   cwd=path, stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+def latencies(find, queries):
+    times = []
+    for counts in queries:
+        start = time.perf_counter()
+        find(counts)
+        times.append((time.perf_counter() - start) * 1000)
+    q = statistics.quantiles(times, n=100)
+    return {'p50': q[49], 'p99': q[98], 'mean': statistics.mean(times)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark index.py and search.py on a synthetic catalogue.')
+    parser.add_argument('--songs', type=int, default=10000)
+    parser.add_argument('--queries', type=at_least(2), default=1000, help='queries per query length (at least 2)')
+    parser.add_argument('--jobs', type=int, default=1, help='worker processes for index.py')
+    parser.add_argument('--compact', action='store_true', help='also search songs.idx')
+    parser.add_argument('--seed', type=int, default=2017)
+    parser.add_argument('--dir', help='catalogue directory to create or reuse (default: temporary)')
+    parser.add_argument('--output', help='write the results to a file instead of stdout')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    path = args.dir or tempfile.mkdtemp(prefix='songs-')
+    songs = os.path.join(path, 'songs')
+    results = {'songs': args.songs, 'jobs': args.jobs, 'seed': args.seed}
+    try:
+        if os.path.isdir(songs):
+            draw = zipf(vocabulary(max(1000, args.songs // 10), rng), rng)
+        else:
+            start = time.perf_counter()
+            draw = generate(songs, args.songs, rng)
+            results['generate'] = time.perf_counter() - start
+        results['songs'] = len(os.listdir(songs))
+
+        options = ['--rebuild', '--jobs', str(args.jobs)] + (['--compact'] if args.compact else [])
+        seconds = index(path, *options)
+        results['index'] = {'seconds': seconds, 'files_per_sec': results['songs'] / seconds}
+        results['reindex'] = {'seconds': index(path, '--jobs', str(args.jobs))}
+        results['db_bytes'] = os.path.getsize(os.path.join(path, 'songs.db'))
+
+        conn = connect(os.path.join(path, 'songs.db'))
+        queries = {n: [count(draw(n)) for _ in range(args.queries)] for n in range(1, LONGEST + 1)}
+        results['search'] = {n: latencies(lambda counts: search(conn, counts, LIMIT, RANKING), queries[n])
+                             for n in queries}
+        if args.compact:
+            from compact import CompactIndex
+            compact = CompactIndex(os.path.join(path, 'songs.idx'))
+            results['idx_bytes'] = os.path.getsize(os.path.join(path, 'songs.idx'))
+            results['compact'] = {n: latencies(lambda counts: compact.search(counts, LIMIT, RANKING), queries[n])
+                                  for n in queries}
+    finally:
+        if not args.dir:
+            shutil.rmtree(path)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,37 @@
+# codec.py
+# Compact encoding of lists of integers.
+#
+# Each number is stored as the difference to the one before it,
+# written as a varint: seven bits per byte, low bits first, with
+# the high bit set on every byte but the last. Small gaps, as
+# between term positions or sorted song numbers, take one byte.
+# With delta=False the numbers themselves are written, for lists
+# that are not sorted such as term counts.
+
+def encode(numbers, delta=True):
+    out = bytearray()
+    last = 0
+    for n in numbers:
+        d = n - last
+        if delta:
+            last = n
+        while d >= 0x80:
+            out.append(d & 0x7f | 0x80)
+            d >>= 7
+        out.append(d)
+    return bytes(out)
+
+def decode(data, delta=True):
+    numbers = []
+    n = shift = last = 0
+    for b in data:
+        n |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            if delta:
+                last += n
+                n = last
+            numbers.append(n)
+            n = shift = 0
+    return numbers
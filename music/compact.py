@@ -0,0 +1,125 @@
+# compact.py
+# Compact binary index file for the song search.
+#
+# Usage: compact.py
+#
+# Writes songs.idx from the document term matrix in songs.db.
+# Songs are numbered in id order and every term has a posting
+# list of song numbers (delta and varint encoded, see codec.py)
+# and term counts (varint encoded). The file is laid out as
+#
+#   header   magic, byte order, songs, terms, total length
+#   ids      16 byte md5 id of every song
+#   lengths  uint32 length of every song
+#   offsets  uint64 end of every term, of its song numbers and of
+#            its term counts in the three sections below
+#   terms    sorted utf-8 terms
+#   songs    song numbers of every term
+#   counts   term counts of every term
+#
+# with every section starting at a multiple of 8 bytes. It is
+# opened with mmap: a search process maps it instead of reading
+# it, and processes searching at the same time share its pages.
+# Song details still come from songs.db.
+
+import array, itertools, mmap, os, struct, sys
+from operator import itemgetter
+
+import codec
+from ranking import RANKINGS
+from search import LIMIT, RANKING, connect, score
+
+IDX = 'songs.idx'
+MAGIC = b'HOARDIX1'
+HEADER = struct.Struct('<8s8sQQd')
+
+def pad(n):
+    return -n % 8
+
+def build(conn, path=IDX):
+    ids = [id for id, in conn.execute('select id from song order by id')]
+    numbers = {id: i for i, id in enumerate(ids)}
+    lengths = array.array('I', bytes(4*len(ids)))
+    for id, length in conn.execute('select id, length from song'):
+        lengths[numbers[id]] = length
+    offsets = array.array('Q', [0, 0, 0])
+    terms, songs, counts = bytearray(), bytearray(), bytearray()
+    size = 0
+    for term, rows in itertools.groupby(conn.execute('select term, id, value from matrix order by term, id'),
+                                        key=itemgetter(0)):
+        rows = list(rows)
+        terms += term.encode('utf-8')
+        songs += codec.encode(numbers[id] for _, id, _ in rows)
+        counts += codec.encode((value for _, _, value in rows), delta=False)
+        offsets.extend((len(terms), len(songs), len(counts)))
+        size += 1
+    header = HEADER.pack(MAGIC, sys.byteorder.encode('ascii'), len(ids), size, float(sum(lengths)))
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        for section in (header, b''.join(bytes.fromhex(id) for id in ids), lengths.tobytes(),
+                        offsets.tobytes(), terms, songs, counts):
+            f.write(section)
+            f.write(bytes(pad(len(section))))
+    os.replace(tmp, path)
+    return len(ids), size
+
+
+class CompactIndex:
+    def __init__(self, path=IDX):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, order, self.songs, self.size, self.length = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError('{} is not a song index'.format(path))
+        if order.rstrip(b'\0').decode('ascii') != sys.byteorder:
+            raise ValueError('{} was written on a {} endian machine'.format(path, order.rstrip(b'\0').decode('ascii')))
+        view = memoryview(self.mm)
+        pos = HEADER.size
+        sections = []
+        for n in (16*self.songs, 4*self.songs, 24*(self.size + 1)):
+            sections.append(view[pos:pos + n])
+            pos += n + pad(n)
+        self.ids = sections[0]
+        self.lengths = sections[1].cast('I')
+        self.offsets = sections[2].cast('Q')
+        for n in self.offsets[-3:]:
+            sections.append(view[pos:pos + n])
+            pos += n + pad(n)
+        self.terms, self.docs, self.counts = sections[3:]
+
+    def find(self, term):
+        key = term.encode('utf-8')
+        off = self.offsets
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = bytes(self.terms[off[3*mid]:off[3*mid + 3]])
+            if t < key:
+                lo = mid + 1
+            elif t > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def postings(self, term):
+        i = self.find(term)
+        if i is None:
+            return 0, ()
+        off = self.offsets
+        songs = codec.decode(self.docs[off[3*i + 1]:off[3*i + 4]])
+        counts = codec.decode(self.counts[off[3*i + 2]:off[3*i + 5]], delta=False)
+        return len(songs), [(n, tf, self.lengths[n]) for n, tf in zip(songs, counts)]
+
+    def id(self, n):
+        return self.ids[16*n:16*n + 16].hex()
+
+    def search(self, counts, limit=LIMIT, rank_by=RANKING):
+        ranking = RANKINGS[rank_by](self.songs, self.length)
+        return [(self.id(n), s) for n, s in score(ranking, self.postings, counts, limit)]
+
+
+if __name__ == '__main__':
+    songs, terms = build(connect())
+    print('Wrote {} songs, {} terms to {} ({} bytes, songs.db is {} bytes).'.format(
+        songs, terms, IDX, os.path.getsize(IDX), os.path.getsize('songs.db')))
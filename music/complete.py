@@ -0,0 +1,69 @@
+# complete.py
+# Prefix completion of queries for search-as-you-type.
+#
+# Usage: complete.py <partial query>
+#
+# The vocabulary is held as a sorted array of terms with the
+# number of songs each occurs in. The completions of a prefix are
+# a contiguous slice of the array found by bisection, of which
+# the most frequent terms are picked with a heap. Results for
+# prefixes of up to SHORT characters, whose slices are the
+# largest, are cached. The last word of a query is completed and
+# each completion comes with its best songs. server.py serves the
+# same completions at /complete for interactive use.
+
+import bisect, heapq, sys
+
+from search import connect, count, normalize, search
+
+COMPLETIONS = 5
+SONGS = 3
+SHORT = 2
+
+
+class Completer:
+    def __init__(self, terms, dfs):
+        self.terms, self.dfs = terms, dfs
+        self.cache = {}
+
+    @classmethod
+    def load(cls, conn):
+        terms, dfs = [], []
+        for term, df in conn.execute('select term, df from vocabulary order by term'):
+            terms.append(term)
+            dfs.append(df)
+        return cls(terms, dfs)
+
+    def complete(self, prefix, limit=COMPLETIONS):
+        key = (prefix, limit)
+        if key in self.cache:
+            return self.cache[key]
+        lo = bisect.bisect_left(self.terms, prefix)
+        hi = bisect.bisect_left(self.terms, prefix + '\U0010ffff', lo)
+        best = [(self.terms[i], self.dfs[i]) for i in heapq.nlargest(limit, range(lo, hi), key=self.dfs.__getitem__)]
+        if len(prefix) <= SHORT:
+            self.cache[key] = best
+        return best
+
+def suggest(completer, find, text, limit=COMPLETIONS, songs=SONGS):
+    """Complete the last word of text. find(terms, k) returns the k
+    best songs for a list of terms."""
+    words = normalize([text])
+    if not words:
+        return []
+    head, prefix = words[:-1], words[-1]
+    return [(' '.join(head + [term]), df, find(head + [term], songs))
+            for term, df in completer.complete(prefix, limit)]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        print('Usage:', sys.argv[0], '<partial query>')
+        exit()
+
+    conn = connect()
+    completer = Completer.load(conn)
+    for query, df, rows in suggest(completer, lambda q, k: search(conn, count(q), k), ' '.join(sys.argv[1:])):
+        print('{} ({} songs)'.format(query, df))
+        for score, artist, title, filename in rows:
+            print('  ', artist, '-', title)
@@ -0,0 +1,200 @@
+# dedup.py
+# Find duplicate songs by their contents rather than their names.
+#
+# Usage: dedup.py [--jobs n] [--audio]
+#
+# Files are byte for byte duplicates when their contents hash
+# the same. Only files whose size is shared by another file can
+# have a duplicate, so only those are hashed, reading them in
+# CHUNK sized pieces. With --audio every file also gets an audio
+# fingerprint of its first SECONDS seconds: a chromaprint when
+# pyacoustid and libchromaprint are installed, otherwise the
+# loudness contour
+# decoded with audioread (after skipping the lead in quieter
+# than 1/ONSET of the loudest sample, whether each 1/FRAMES
+# second is louder than the one before it). Silent and near
+# constant audio gets no fingerprint. Fingerprints are compared
+# bit by bit, since two encodings of one recording differ in a
+# few bits: songs whose fingerprints differ in at most THRESHOLD
+# of their bits are reported as candidates. Only songs that
+# agree on at least one slice of BAND bytes of their
+# fingerprints are compared, as in locality sensitive hashing,
+# so a few flipped bits still find each other without comparing
+# every pair. Hashes and fingerprints are kept in the content
+# table of songs.db keyed on filename, size and mtime, so
+# unchanged files are never read again; fingerprints are
+# prefixed with their KIND so they are computed again when it
+# changes. --jobs reads files in a pool of worker processes.
+
+import argparse, array, hashlib, multiprocessing, sqlite3, sys
+
+from index import CHUNKSIZE, batches, scan
+
+try:
+    import acoustid
+    from chromaprint import decode_fingerprint
+except ImportError:
+    acoustid = None
+
+try:
+    import audioread
+except ImportError:
+    audioread = None
+
+CHUNK = 1 << 20
+SECONDS = 30
+FRAMES = 10
+LEAD = 10
+SILENCE = 256
+ONSET = 8
+BAND = 2
+THRESHOLD = 0.15
+KIND = 'chromaprint-bits' if acoustid else 'envelope-bits'
+
+def digest(fn):
+    h = hashlib.blake2b(digest_size=20)
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def chromaprint(fn):
+    try:
+        duration, fp = acoustid.fingerprint_file(fn, maxlength=SECONDS)
+    except acoustid.FingerprintGenerationError:
+        return None
+    if not fp:
+        return None
+    raw, algorithm = decode_fingerprint(fp)
+    return b''.join((n & 0xffffffff).to_bytes(4, 'big') for n in raw) or None
+
+def envelope(fn):
+    try:
+        with audioread.audio_open(fn) as f:
+            rate = f.samplerate * f.channels
+            samples = array.array('h')
+            for block in f:
+                samples.frombytes(block)
+                if len(samples) >= rate * (SECONDS + LEAD):
+                    break
+    except (audioread.DecodeError, OSError):
+        return None
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    quiet = max(SILENCE, max(map(abs, samples), default=0) // ONSET)
+    start = next((i for i, s in enumerate(samples[:rate * LEAD]) if abs(s) > quiet), None)
+    if start is None:
+        return None
+    frame = rate // FRAMES
+    end = min(len(samples), start + rate * SECONDS)
+    levels = [sum(map(abs, samples[i:i + frame])) for i in range(start, end - frame + 1, frame)]
+    if len(levels) < FRAMES * SECONDS // 2 or max(levels) - min(levels) < max(levels) / 10:
+        return None
+    rising = [b > a for a, b in zip(levels, levels[1:])]
+    n = 0
+    for bit in rising:
+        n = n << 1 | bit
+    return (n << -len(rising) % 8).to_bytes((len(rising) + 7) // 8, 'big')
+
+def fingerprint(fn):
+    fp = chromaprint(fn) if acoustid else envelope(fn)
+    return KIND + ':' + (fp.hex() if fp else '')
+
+def distance(a, b):
+    n = min(len(a), len(b))
+    return bin(int.from_bytes(a[:n], 'big') ^ int.from_bytes(b[:n], 'big')).count('1') / (8 * n)
+
+def similar(prints):
+    buckets = {}
+    for fn, fp in prints.items():
+        for i in range(0, len(fp) - BAND + 1, BAND):
+            buckets.setdefault((i, fp[i:i + BAND]), []).append(fn)
+    parent = {fn: fn for fn in prints}
+    def find(fn):
+        while parent[fn] != fn:
+            parent[fn] = parent[parent[fn]]
+            fn = parent[fn]
+        return fn
+    compared = set()
+    for fns in buckets.values():
+        for i, a in enumerate(fns):
+            for b in fns[i + 1:]:
+                if (a, b) not in compared:
+                    compared.add((a, b))
+                    if find(a) != find(b) and distance(prints[a], prints[b]) <= THRESHOLD:
+                        parent[find(a)] = find(b)
+    groups = {}
+    for fn in prints:
+        groups.setdefault(find(fn), []).append(fn)
+    return groups
+
+def examine(item):
+    fn, hash_bytes, hash_audio = item
+    return (fn,
+            digest(fn) if hash_bytes else None,
+            fingerprint(fn) if hash_audio else None)
+
+def report(title, groups):
+    groups = sorted(sorted(fns) for fns in groups.values() if len(fns) > 1)
+    print(title)
+    for fns in groups:
+        print('  ', fns[0])
+        for fn in fns[1:]:
+            print('    =', fn)
+    return len(groups)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find duplicate songs by content.')
+    parser.add_argument('--jobs', type=int, default=1, help='worker processes for reading files')
+    parser.add_argument('--audio', action='store_true', help='also compare decoded audio (needs pyacoustid or audioread)')
+    args = parser.parse_args()
+    if args.audio and acoustid is None and audioread is None:
+        parser.error('--audio needs pyacoustid or audioread')
+
+    conn = sqlite3.connect('songs.db')
+    conn.execute('pragma journal_mode=wal')
+    conn.execute('create table if not exists content(filename text, size int, mtime real, digest text, fingerprint text, primary key(filename))')
+
+    files = {fn: (size, mtime) for fn, size, mtime in scan()}
+    sizes = {}
+    for size, mtime in files.values():
+        sizes[size] = sizes.get(size, 0) + 1
+
+    known = {}
+    work = []
+    for fn, (size, mtime) in sorted(files.items()):
+        row = conn.execute('select digest, fingerprint from content where filename = ? and size = ? and mtime = ?',
+                           (fn, size, mtime)).fetchone()
+        known[fn] = row or (None, None)
+        hash_bytes = sizes[size] > 1 and known[fn][0] is None
+        hash_audio = args.audio and not (known[fn][1] or '').startswith(KIND + ':')
+        if hash_bytes or hash_audio:
+            work.append((fn, hash_bytes, hash_audio))
+    print('Files:', len(files))
+    print('To read:', len(work))
+
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    results = pool.imap_unordered(examine, work, chunksize=CHUNKSIZE) if pool else map(examine, work)
+    with conn:
+        for batch in batches(results):
+            rows = []
+            for fn, d, f in batch:
+                known[fn] = (d or known[fn][0], f or known[fn][1])
+                rows.append((fn,) + files[fn] + known[fn])
+            conn.executemany('insert or replace into content(filename, size, mtime, digest, fingerprint) values(?, ?, ?, ?, ?)', rows)
+        gone = [(fn,) for fn, in conn.execute('select filename from content') if fn not in files]
+        conn.executemany('delete from content where filename = ?', gone)
+    if pool:
+        pool.close()
+        pool.join()
+
+    by_digest, prints = {}, {}
+    for fn, (d, f) in known.items():
+        if d and sizes[files[fn][0]] > 1:
+            by_digest.setdefault(d, []).append(fn)
+        if args.audio and f and f.startswith(KIND + ':') and f != KIND + ':':
+            prints[fn] = bytes.fromhex(f[len(KIND) + 1:])
+    print('Duplicates:', report('Identical files:', by_digest))
+    if args.audio:
+        print('Audio duplicate candidates:', report('Possibly the same recording:', similar(prints)))
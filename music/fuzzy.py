@@ -0,0 +1,46 @@
+# fuzzy.py
+# Typo tolerant matching of query terms against the vocabulary.
+#
+# index.py keeps a trigram table of the distinct terms in matrix,
+# one row per (trigram, term length, term). A query term that is
+# not in the vocabulary is expanded to the vocabulary terms within
+# a small edit distance: only terms of a similar length that share
+# enough trigrams with it are looked up, so the cost depends on
+# the trigrams of the query term and not on the vocabulary size.
+
+EXPANSIONS = 5
+
+def grams(term):
+    padded = '$' + term + '$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edits(term):
+    return 1 if len(term) <= 5 else 2
+
+def distance(a, b):
+    """Levenshtein distance between a and b."""
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+def expand(conn, term, limit=EXPANSIONS):
+    if conn.execute('select 1 from vocabulary where term = ?', (term,)).fetchone():
+        return [term]
+    k = edits(term)
+    g = grams(term)
+    shared = {}
+    for gram in g:
+        for t, in conn.execute('select term from trigram where gram = ? and length between ? and ?',
+                               (gram, len(term) - k, len(term) + k)):
+            shared[t] = shared.get(t, 0) + 1
+    # Every edit destroys at most three of the trigrams of a term.
+    need = max(1, len(g) - 3*k)
+    matches = sorted((distance(term, t), t) for t, n in shared.items() if n >= need)
+    return [t for d, t in matches if d <= k][:limit]
+
+def expand_all(conn, terms, limit=EXPANSIONS):
+    return [t for term in terms for t in expand(conn, term, limit)]
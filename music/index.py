@@ -5,22 +5,94 @@
 # Just an exercise, I know there are better ways
 # to do this.
 #
+# Usage: index.py [--rebuild] [--sparse [--rank bm25|tfidf|count]]
+#                 [--compact] [--jobs n]
+#
+# By default the index is updated incrementally: each song row
+# records the file's size and mtime, and only files that were
+# added, changed or removed since the last run touch the song
+# and matrix tables. The whole update runs in one transaction
+# against a WAL database so searches keep working meanwhile.
+# --rebuild drops both tables and indexes everything again.
+# --sparse also exports songs.npz for sparse.py afterwards,
+# weighted by the --rank ranking.
+# --compact also writes songs.idx for search.py --compact.
+# --jobs spreads parsing and hashing of the filenames over a pool
+# of worker processes; the parsed songs are streamed back in
+# chunks and inserted while the workers go on.
+#
+# Parsed songs flow through a generator pipeline and are written
+# in batches of BATCH songs, so memory does not grow with the
+# size of the catalogue beyond a filename and an id per song.
+# Duplicates (songs whose normalized names hash to the same id)
+# are found with a dict from id to filename. A duplicate file is
+# recorded in the duplicate table with its size, mtime and the id
+# of the song it duplicates, so later runs see it as unchanged
+# instead of parsing it again. When that song is removed its
+# duplicates are indexed in its place.
+#
+# The postings index on matrix(term, id, value) is the inverted
+# index: it gives the posting list of a term without touching
+# the rest of the matrix.
+#
+# For ranking (see ranking.py) each song also stores its length
+# in terms, the vocabulary table holds the number of songs each
+# term occurs in, and the stats table the number of songs and
+# their total length. They are kept up to date incrementally.
+#
+# Names are normalized with normalize.fold(), the same function
+# search.py applies to queries. The stats table records its
+# VERSION and the index is rebuilt when it changes. Every run
+# that changes the index also increments its generation, which
+# tells server.py to reload and drop its cached results; it is
+# kept across rebuilds.
+#
+# The trigram table indexes the vocabulary itself for fuzzy
+# matching of misspelled query terms (see fuzzy.py).
+#
+# The field table holds the same postings split by the field
+# (artist, title or album) the term occurs in, for field
+# qualified queries.
+#
+# Each matrix row also holds the positions of the term in the
+# song, delta and varint encoded (see codec.py), for phrase and
+# proximity scoring. Artist, title and album are GAP positions
+# apart so that phrases do not run from one into the next.
+#
+# Artist, title, album and duration come from the embedded tags
+# when mutagen is installed, and from the filename otherwise (see
+# tags.py). The album is searchable along with artist and title.
+# Tags read are kept in the tag table keyed on filename, size and
+# mtime, which --rebuild leaves alone, so a file's tags are only
+# read again after it changes. The cache is looked up one file at
+# a time as the files are handed to the parser, through a second
+# connection that sees the tags committed by earlier runs. With
+# --jobs the tags are read in the worker processes. Without
+# mutagen nothing is cached.
+#
+# The work is done by the Indexer class, which other programs can
+# use to keep a catalogue indexed: update() does what this script
+# does for any list of files, add() and remove() index or drop
+# single files, and commit() makes the changes visible to
+# searches. It keeps its connection and worker pool across calls,
+# and the indexed files and the stats in memory between
+# transactions; they are only read again after a rebuild or when
+# another connection has written to songs.db since (sqlite's
+# data_version), which also catches changes that leave the
+# generation alone such as new duplicates.
+#
 # Mark Documento 2017/03/17
 
-import glob, hashlib, os, re, sqlite3, string
-
-common_diacritics = {
-    'a': 'âäàá',
-    'e': 'êëèé',
-    'i': 'îïìí',
-    'o': 'ôöòó',
-    'u': 'ûüùú',
-    'w': 'ŵẅẁẃ',
-    'y': 'ŷÿỳý'
-}
-rx1 = re.compile('[%s]' % re.escape(string.punctuation))
-rx2 = {letter: re.compile('[%s]' % re.escape(letters))
-       for letter, letters in common_diacritics.items()}
+import argparse, glob, hashlib, multiprocessing, os, sqlite3, time
+
+import codec, fuzzy, normalize, tags
+from ranking import RANKINGS
+from search import RANKING
+
+CHUNKSIZE = 256
+BATCH = 1000
+FIELDS = ('album', 'artist', 'title')
+GAP = 8
 
 def count(terms):
     l = {}
@@ -28,66 +100,325 @@ def count(terms):
         l[t] = l[t] + 1 if t in l else 1
     return l
 
+def scan(pattern='songs/*.mp3'):
+    for fn in sorted(glob.glob(pattern)):
+        st = os.stat(fn)
+        yield fn, st.st_size, st.st_mtime
+
+def batches(items, size=BATCH):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def parse(item):
+    fn, cached = item
+    meta = tags.read(fn) if cached is None else cached
+    artist, title = tags.from_filename(fn)
+    artist = meta['artist'] or artist
+    title = meta['title'] or title
+
+    s = normalize.fold(artist + ' ' + title)
 
-conn = sqlite3.connect('songs.db')
-cur = conn.cursor()
-cur.execute('drop table if exists song')
-cur.execute('create table song(id text, artist text, title text, filename text, primary key(id), unique(artist, title))')
-cur.execute('drop table if exists matrix')
-cur.execute('create table matrix(id text, term text, value int, primary key(id, term))')
-
-sql1 = []
-sql2 = []
-songs = []
-ids = {}
-for fn in sorted(glob.glob('songs/*.mp3')):
-    noext = os.path.splitext(os.path.basename(fn))[0]
-    pair = re.findall('(.*?)-\s*(.*?)\[', noext)[0]
-    artist, title = pair
-    artist = ' '.join([w.strip() for w in artist.split()])
-    title = ' '.join([w.strip() for w in title.split()])
-
-    s = artist + ' ' + title
-    s = rx1.sub('', s).lower()
-    for letter, rx in rx2.items():
-        s = rx.sub(letter, s)
-        
-    terms = sorted(s.split())
+    fields = {'artist': count(normalize.terms(artist)),
+              'title': count(normalize.terms(title)),
+              'album': count(normalize.terms(meta['album']))}
+
+    terms = sorted((s + ' ' + normalize.fold(meta['album'])).split())
+
+    positions = {}
+    offset = 0
+    for words in (normalize.terms(artist), normalize.terms(title), normalize.terms(meta['album'])):
+        for i, term in enumerate(words):
+            positions.setdefault(term, []).append(offset + i)
+        offset += len(words) + GAP
 
     md5 = hashlib.md5()
-    
+
     md5.update(s.encode('utf-8'))
     id = md5.hexdigest()
-    ids[id] = ids[id] + 1 if id in ids else 1
 
-    song = {
+    return {
         'id': id,
         'artist': artist,
         'title': title,
+        'album': meta['album'],
+        'duration': meta['duration'],
         'filename': fn,
-        'terms': count(terms)
+        'terms': count(terms),
+        'fields': fields,
+        'positions': positions,
+        'tags': meta if cached is None else None
     }
-    songs.append(song)
 
-    sql1.append((id, artist, title, fn))
-    for term in sorted(song['terms'].keys()):
-        sql2.append((id, term, song['terms'][term]))
 
-print('Songs:', len(sql1))
-print('Matrix:', len(sql2))
+class Indexer:
+    """Adds songs to and removes them from songs.db. Changes are
+    made in one transaction which commit() finishes after bringing
+    the vocabulary, trigrams and stats up to date; the next change
+    starts a new one. log, if given, is called with progress
+    messages like print."""
+
+    def __init__(self, path='songs.db', rebuild=False, jobs=1, log=None):
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute('pragma journal_mode=wal')
+        self.cur = self.conn.cursor()
+        self.jobs = jobs
+        self.log = log or (lambda *args: None)
+        self.pool = None
+        self.indexed = None
+        self.rebuild = rebuild or self.outdated()
+        self.cur.execute('create table if not exists tag(filename text, size int, mtime real, artist text, title text, album text, duration real, primary key(filename))')
+        self.cache = sqlite3.connect(path, check_same_thread=False)
+
+    def outdated(self):
+        cur = self.cur
+        columns = [row[1] for row in cur.execute('pragma table_info(song)')]
+        tables = [name for name, in cur.execute("select name from sqlite_master where type = 'table'")]
+        matrix = [row[1] for row in cur.execute('pragma table_info(matrix)')]
+        if columns and (not {'mtime', 'length', 'album', 'duration'} <= set(columns) or not {'trigram', 'field'} <= set(tables)
+                        or 'positions' not in matrix):
+            self.log('Index format has changed, rebuilding.')
+            return True
+        elif columns:
+            version = cur.execute("select value from stats where key = 'normalizer'").fetchone()
+            if version is None or version[0] != normalize.VERSION:
+                self.log('Normalization has changed, rebuilding.')
+                return True
+        return False
+
+    def begin(self):
+        if self.conn.in_transaction:
+            return
+        cur = self.cur
+        tables = [name for name, in cur.execute("select name from sqlite_master where type = 'table'")]
+        cur.execute('begin immediate')
+        self.generation = 0
+        if 'stats' in tables:
+            row = cur.execute("select value from stats where key = 'generation'").fetchone()
+            self.generation = row[0] if row else 0
+        version, = cur.execute('pragma data_version').fetchone()
+        stale = self.rebuild or self.indexed is None or version != self.version
+        self.version = version
+        self.dirty = self.rebuild
+        if self.rebuild:
+            cur.execute('drop table if exists song')
+            cur.execute('drop table if exists matrix')
+            cur.execute('drop table if exists vocabulary')
+            cur.execute('drop table if exists stats')
+            cur.execute('drop table if exists trigram')
+            cur.execute('drop table if exists field')
+            cur.execute('drop table if exists duplicate')
+            self.rebuild = False
+        cur.execute('create table if not exists song(id text, artist text, title text, album text, duration real, filename text, size int, mtime real, length int, primary key(id), unique(artist, title))')
+        cur.execute('create table if not exists matrix(id text, term text, value int, positions blob, primary key(id, term))')
+        cur.execute('create index if not exists postings on matrix(term, id, value)')
+        cur.execute('create table if not exists field(field text, term text, id text, value int, primary key(field, term, id)) without rowid')
+        cur.execute('create table if not exists vocabulary(term text, df int, primary key(term))')
+        cur.execute('create table if not exists stats(key text, value, primary key(key))')
+        cur.execute('create table if not exists trigram(gram text, length int, term text, primary key(gram, length, term)) without rowid')
+        cur.execute('create table if not exists duplicate(filename text, size int, mtime real, id text, primary key(filename))')
+
+        if stale:
+            self.indexed = {}
+            self.songs = self.length = 0
+            for filename, id, size, mtime, length in cur.execute('select filename, id, size, mtime, length from song'):
+                self.indexed[filename] = (id, size, mtime)
+                self.songs += 1
+                self.length += length
+            self.owners = {id: fn for fn, (id, size, mtime) in self.indexed.items()}
+            self.duplicates = {filename: (id, size, mtime)
+                               for filename, id, size, mtime in cur.execute('select filename, id, size, mtime from duplicate')}
+        self.touched = set()
+
+    def update(self, files):
+        """Bring the index in line with files, an iterable of
+        (filename, size, mtime) such as scan() returns: index new
+        and changed files and remove the ones that are gone."""
+        self.begin()
+        seen = set()
+        added, changed, pending = [], [], []
+        for fn, size, mtime in files:
+            seen.add(fn)
+            known = self.indexed.get(fn) or self.duplicates.get(fn)
+            if known is None:
+                added.append(fn)
+            elif (size, mtime) != known[1:]:
+                changed.append(fn)
+            else:
+                continue
+            pending.append((fn, size, mtime))
+        removed = [fn for fn in list(self.indexed) + list(self.duplicates) if fn not in seen]
+
+        self.log('Added:', len(added))
+        self.log('Changed:', len(changed))
+        self.log('Removed:', len(removed))
+
+        self.log('Deleting stale songs...')
+        self.remove(removed + changed)
+        self.cur.executemany('delete from tag where filename = ?', [(fn,) for fn in removed])
+        self.add(pending)
+        return added, changed, removed
+
+    def remove(self, filenames):
+        """Remove the songs of filenames from the index. Duplicates
+        of a removed song are indexed in its place."""
+        self.begin()
+        cur = self.cur
+        filenames = set(filenames)
+        for fn in filenames & set(self.duplicates):
+            del self.duplicates[fn]
+            cur.execute('delete from duplicate where filename = ?', (fn,))
+        filenames = [fn for fn in filenames if fn in self.indexed]
+        ids = set()
+        for fn in filenames:
+            id = self.indexed.pop(fn)[0]
+            terms = [term for term, in cur.execute('select term from matrix where id = ?', (id,))]
+            self.touched.update(terms)
+            cur.executemany('delete from field where field = ? and term = ? and id = ?',
+                            [(field, term, id) for field in FIELDS for term in terms])
+            cur.execute('delete from matrix where id = ?', (id,))
+            length, = cur.execute('select length from song where id = ?', (id,)).fetchone()
+            cur.execute('delete from song where id = ?', (id,))
+            self.songs -= 1
+            self.length -= length
+            if self.owners.get(id) == fn:
+                del self.owners[id]
+            ids.add(id)
+            self.dirty = True
+        revived = [(fn, size, mtime) for fn, (id, size, mtime) in self.duplicates.items() if id in ids]
+        if revived:
+            self.log('Reindexing duplicates:', len(revived))
+            self.add(revived)
+
+    def add(self, files):
+        """Index files, an iterable of (filename, size, mtime). Files
+        that are already indexed are indexed again."""
+        self.begin()
+        cur = self.cur
+        pending = {fn: (size, mtime) for fn, size, mtime in files}
+        self.remove([fn for fn in pending if fn in self.indexed or fn in self.duplicates])
+
+        self.log('Inserting songs...')
+        dups = 0
+        terms = 0
+        start = time.perf_counter()
+        cached = 0
+        def items():
+            nonlocal cached
+            for fn in sorted(pending):
+                row = None
+                if tags.mutagen:
+                    row = self.cache.execute('select artist, title, album, duration from tag where filename = ? and size = ? and mtime = ?',
+                                             (fn,) + pending[fn]).fetchone()
+                cached += row is not None
+                yield fn, dict(zip(tags.FIELDS, row)) if row else None
+        if self.jobs > 1 and self.pool is None:
+            self.pool = multiprocessing.Pool(self.jobs)
+        parsed = self.pool.imap(parse, items(), chunksize=CHUNKSIZE) if self.pool else map(parse, items())
+        for batch in batches(parsed):
+            sql1 = []
+            sql2 = []
+            sql3 = []
+            sql4 = []
+            sql5 = []
+            for song in batch:
+                id, fn = song['id'], song['filename']
+                if song['tags'] is not None and tags.mutagen:
+                    sql3.append((fn,) + pending[fn] + tuple(song['tags'][field] for field in tags.FIELDS))
+                if id in self.owners:
+                    self.log('Duplicate:', fn, 'of', self.owners[id])
+                    dups += 1
+                    self.duplicates[fn] = (id,) + pending[fn]
+                    sql5.append((fn,) + pending[fn] + (id,))
+                    continue
+                self.owners[id] = fn
+                size, mtime = pending[fn]
+                self.indexed[fn] = (id, size, mtime)
+                sql1.append((id, song['artist'], song['title'], song['album'], song['duration'], fn, size, mtime,
+                             sum(song['terms'].values())))
+                sql2.extend((id, term, n, codec.encode(song['positions'][term])) for term, n in sorted(song['terms'].items()))
+                sql4.extend((field, term, id, n) for field in FIELDS for term, n in sorted(song['fields'][field].items()))
+                self.touched.update(song['terms'])
+            cur.executemany('insert or replace into tag(filename, size, mtime, artist, title, album, duration) values(?, ?, ?, ?, ?, ?, ?)', sql3)
+            cur.executemany('insert into song(id, artist, title, album, duration, filename, size, mtime, length) values(?, ?, ?, ?, ?, ?, ?, ?, ?)', sql1)
+            cur.executemany('insert into matrix(id, term, value, positions) values(?, ?, ?, ?)', sql2)
+            cur.executemany('insert into field(field, term, id, value) values(?, ?, ?, ?)', sql4)
+            cur.executemany('insert into duplicate(filename, size, mtime, id) values(?, ?, ?, ?)', sql5)
+            terms += len(sql2)
+            if sql1:
+                self.songs += len(sql1)
+                self.length += sum(row[-1] for row in sql1)
+                self.dirty = True
+        elapsed = time.perf_counter() - start
+        self.log('Indexed {} files in {:.2f}s ({:.0f} files/sec)'.format(len(pending), elapsed,
+                                                                      len(pending) / elapsed if elapsed else 0))
+
+        self.log('Cached tags:', cached)
+        self.log('Duplicates:', dups)
+        self.log('Matrix:', terms)
+
+    def commit(self):
+        """Update the vocabulary, trigrams and stats for the changes
+        so far and commit them."""
+        if not self.conn.in_transaction:
+            return
+        cur = self.cur
+        self.log('Updating vocabulary...')
+        for term in sorted(self.touched):
+            df, = cur.execute('select count(*) from matrix where term = ?', (term,)).fetchone()
+            known = cur.execute('select 1 from vocabulary where term = ?', (term,)).fetchone()
+            trigrams = [(gram, len(term), term) for gram in fuzzy.grams(term)]
+            if df:
+                cur.execute('insert or replace into vocabulary(term, df) values(?, ?)', (term, df))
+                if not known:
+                    cur.executemany('insert into trigram(gram, length, term) values(?, ?, ?)', trigrams)
+            elif known:
+                cur.execute('delete from vocabulary where term = ?', (term,))
+                cur.executemany('delete from trigram where gram = ? and length = ? and term = ?', trigrams)
+        cur.execute("insert or replace into stats(key, value) values('songs', ?)", (self.songs,))
+        cur.execute("insert or replace into stats(key, value) values('length', ?)", (float(self.length),))
+        cur.execute("insert or replace into stats(key, value) values('normalizer', ?)", (normalize.VERSION,))
+        if self.dirty:
+            self.generation += 1
+        cur.execute("insert or replace into stats(key, value) values('generation', ?)", (self.generation,))
+        cur.execute('commit')
 
-dups = [[song for song in songs if song['id'] == id] for id, n in ids.items() if n > 1]
-for dup in dups:
-    for du in dup:
-        print(du)
+    def close(self):
+        """Stop the worker processes and close songs.db, dropping
+        uncommitted changes."""
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.cache.close()
+        self.conn.close()
 
-print('Duplicates:', len(dups))
 
-print('Inserting into songs...')
-cur.executemany('insert into song(id, artist, title, filename) values(?, ?, ?, ?)', sql1)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index songs/*.mp3 into songs.db.')
+    parser.add_argument('--rebuild', action='store_true', help='drop the index and index everything again')
+    parser.add_argument('--sparse', action='store_true', help='also export songs.npz for sparse.py')
+    parser.add_argument('--rank', choices=sorted(RANKINGS), default=RANKING, help='ranking songs.npz is weighted by')
+    parser.add_argument('--compact', action='store_true', help='also write songs.idx for compact.py')
+    parser.add_argument('--jobs', type=int, default=1, help='worker processes for parsing filenames')
+    args = parser.parse_args()
 
-print('Inserting into matrix...')
-cur.executemany('insert into matrix(id, term, value) values(?, ?, ?)', sql2)
+    indexer = Indexer(rebuild=args.rebuild, jobs=args.jobs, log=print)
+    indexer.update(scan())
+    indexer.commit()
 
-conn.commit()
-print('Done.')
+    if args.sparse:
+        from sparse import export
+        print('Exporting sparse matrix...')
+        export(indexer.conn, rank_by=args.rank)
+    if args.compact:
+        from compact import build
+        print('Writing compact index...')
+        build(indexer.conn)
+    indexer.close()
+    print('Done.')
@@ -0,0 +1,62 @@
+# phrase.py
+# Phrase matching and proximity scoring with term positions.
+#
+# index.py stores the positions of every term in every song
+# (see codec.py). A quoted phrase only keeps the songs in which
+# its terms occur one after another; positions are only read for
+# songs that contain all of the phrase's terms. Songs among the
+# best POOL in which the query terms occur close together, or in
+# query order, get a boost on top of their ranking score.
+
+from ranking import topk
+
+POOL = 100
+PROXIMITY = 1.0
+ORDER = 1.0
+
+def adjacent(lists):
+    """Whether some position in lists[0] is followed by one in
+    lists[1], then lists[2] and so on."""
+    rest = [set(positions) for positions in lists[1:]]
+    return any(all(p + i in s for i, s in enumerate(rest, 1)) for p in lists[0])
+
+def span(lists):
+    """Length of the shortest stretch with a position of each list."""
+    events = sorted((p, i) for i, positions in enumerate(lists) for p in positions)
+    have = {}
+    best = None
+    lo = 0
+    for p, i in events:
+        have[i] = have.get(i, 0) + 1
+        while len(have) == len(lists):
+            q, j = events[lo]
+            best = p - q + 1 if best is None else min(best, p - q + 1)
+            have[j] -= 1
+            if not have[j]:
+                del have[j]
+            lo += 1
+    return best
+
+def apply(scores, terms, phrases, ids_of, positions_of):
+    """Filter scores by phrases and boost the best songs by the
+    proximity of terms, in place. ids_of(term) returns the ids of
+    the songs with term, positions_of(id, term) its positions."""
+    for phrase in phrases:
+        candidates = set(scores)
+        for term in set(phrase):
+            candidates &= ids_of(term)
+        for id in list(scores):
+            if id not in candidates or not adjacent([positions_of(id, term) for term in phrase]):
+                del scores[id]
+    terms = list(dict.fromkeys(terms))
+    if len(terms) < 2:
+        return scores
+    for id, _ in topk(scores, POOL):
+        lists = [positions_of(id, term) for term in terms]
+        found = [positions for positions in lists if positions]
+        if len(found) < 2:
+            continue
+        scores[id] += PROXIMITY*(len(found) - 1)/(span(found) - len(found) + 1)
+        if len(found) == len(lists) and adjacent(lists):
+            scores[id] += ORDER
+    return scores
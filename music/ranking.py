@@ -0,0 +1,100 @@
+# ranking.py
+# Scoring functions for the song search.
+#
+# Each ranking weighs one posting, i.e. a term that occurs tf
+# times in a song of dl terms and in df songs overall, against
+# a query term that occurs qtf times. Document frequencies and
+# lengths are computed by index.py (vocabulary table, song.length
+# and the stats table), so nothing is counted at query time.
+
+import heapq, math
+from operator import itemgetter
+
+
+class Ranking:
+    def __init__(self, songs, length):
+        self.songs = songs
+        self.avgdl = length / songs if songs else 0.0
+
+    def idf(self, df):
+        return math.log((1 + self.songs) / (1 + df)) + 1
+
+    def weight(self, tf, df, dl, qtf):
+        raise NotImplementedError
+
+
+class Count(Ranking):
+    """Raw dot product of term counts."""
+
+    def weight(self, tf, df, dl, qtf):
+        return tf*qtf
+
+
+class TFIDF(Ranking):
+    """Dot product of the tf-idf vectors of the query and the song."""
+
+    def weight(self, tf, df, dl, qtf):
+        return tf*qtf*self.idf(df)**2
+
+
+class BM25(Ranking):
+    """Okapi BM25."""
+
+    k1 = 1.2
+    b = 0.75
+
+    def idf(self, df):
+        return math.log(1 + (self.songs - df + 0.5) / (df + 0.5))
+
+    def weight(self, tf, df, dl, qtf):
+        norm = 1 - self.b + self.b*dl/self.avgdl if self.avgdl else 1
+        return qtf*self.idf(df)*tf*(self.k1 + 1)/(tf + self.k1*norm)
+
+
+RANKINGS = {
+    'bm25': BM25,
+    'count': Count,
+    'tfidf': TFIDF,
+}
+
+def accumulate(ranking, postings, counts, scores=None):
+    """Sum the weights of the postings of every query term.
+    postings(term) returns (df, [(id, tf, dl), ...]). If scores
+    is given only the songs already in it are scored."""
+    if scores is None:
+        scores = {}
+        for term, qtf in counts.items():
+            df, rows = postings(term)
+            for id, tf, dl in rows:
+                scores[id] = scores.get(id, 0) + ranking.weight(tf, df, dl, qtf)
+    else:
+        for term, qtf in counts.items():
+            df, rows = postings(term)
+            for id, tf, dl in rows:
+                if id in scores:
+                    scores[id] += ranking.weight(tf, df, dl, qtf)
+    return scores
+
+def intersect(ranking, field_postings, counts, boosts):
+    """Score the songs that match every (field, term) in counts,
+    weighing each field by its boost. field_postings(field, term)
+    returns (df, [(id, tf, dl), ...]) within that field."""
+    lists = []
+    for (field, term), qtf in counts.items():
+        df, rows = field_postings(field, term)
+        lists.append((boosts[field], df, qtf, list(rows)))
+    lists.sort(key=lambda item: len(item[3]))
+    scores = None
+    for boost, df, qtf, rows in lists:
+        matched = {}
+        for id, tf, dl in rows:
+            if scores is None or id in scores:
+                matched[id] = (0 if scores is None else scores[id]) + boost*ranking.weight(tf, df, dl, qtf)
+        scores = matched
+        if not scores:
+            break
+    return scores or {}
+
+def topk(scores, k):
+    """The k best (id, score) pairs without sorting every match."""
+    return heapq.nlargest(k, scores.items(), key=itemgetter(1))
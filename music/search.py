@@ -1,13 +1,70 @@
 # search.py
-# Commandline search for a song in song.db. 
+# Commandline search for a song in song.db.
+#
+# Usage: search.py [--rank bm25|tfidf|count] [--sparse|--compact] [--fuzzy] <query>
+#        search.py [--rank ...] [--limit n] [--jobs n] --batch [file]
+#
+# Queries are normalized with normalize.fold() like the indexed
+# names, so "Beyoncé" and "beyonce" find the same songs.
+#
+# Scores are accumulated from the posting lists of the query
+# terms only (matrix rows looked up through the postings index),
+# so the cost of a query depends on how common its terms are,
+# not on the size of the catalogue. Songs are ranked with BM25
+# by default (see ranking.py) and only the best LIMIT are kept.
+#
+# songs.db is opened read-only and every statement is a fixed,
+# parameterized select, so any number of searches can run next
+# to each other and next to index.py (which keeps the database
+# in WAL mode).
+#
+# Query words can be qualified with a field, as in
+# "artist:queen title:bohemian". Only songs that match every
+# qualified term are scored, through the per-field postings in
+# the field table, and matches are weighed by the BOOSTS of
+# their fields. Plain terms match any field.
+#
+# Quoted phrases ('"love me do"') only match songs with the
+# words in that order, and songs with the query terms close
+# together or in query order are ranked higher (see phrase.py).
+#
+# With --fuzzy query terms that are not in the vocabulary are
+# replaced by the closest vocabulary terms (see fuzzy.py) before
+# they are ranked, so "beatls" finds The Beatles.
+#
+# With --sparse the query is scored against songs.npz (written by
+# sparse.py export, needs numpy and scipy) and songs.db is only
+# used for the song details. Its scores are weighted when it is
+# exported, so --rank must name the same ranking. --compact does
+# the same with the memory-mapped songs.idx (written by
+# compact.py, see there). Neither supports qualified terms or
+# quoted phrases.
+#
+# If a search server (server.py) is running the query is sent
+# to it instead, otherwise songs.db is searched directly.
+#
+# --batch reads one query per line from a file (or stdin) and
+# writes one JSON object per line with the query and its results.
+# The connection and ranking are set up once per batch, or once
+# per worker process with --jobs.
+#
+# Other programs can search with the Searcher class, which keeps
+# its connection and ranking across searches and sets the ranking
+# up again only when index.py has changed the index.
+#
 # Mark Documento 2017/03/17
 
-import re, sqlite3, string, sys
+import argparse, json, multiprocessing, os, re, sqlite3, sys, urllib.parse, urllib.request
 
-rx = re.compile('[%s]' % re.escape(string.punctuation))
+import codec, fuzzy, normalize as normalizer, phrase
+from ranking import RANKINGS, accumulate, intersect, topk
 
-conn = sqlite3.connect('songs.db')
-cur = conn.cursor()
+BOOSTS = {'artist': 2.0, 'title': 1.5, 'album': 1.0}
+FIELDS = tuple(sorted(BOOSTS))
+LIMIT = 20
+RANKING = 'bm25'
+SERVER = os.environ.get('SONGS_SERVER', 'http://127.0.0.1:8017')
+TIMEOUT = 0.5
 
 def count(terms):
     l = {}
@@ -15,28 +72,199 @@ def count(terms):
         l[t] = l[t] + 1 if t in l else 1
     return l
 
-if len(sys.argv) == 1:
-    print('Usage:', sys.argv[0], '<query>')
-    exit()
+qualified = re.compile('({}):(.*)$'.format('|'.join(FIELDS)), re.IGNORECASE)
+quoted = re.compile('"([^"]*)"')
 
-q = [rx.sub('', term).lower().strip() for term in sys.argv[1:]]
-counts = count(q)
+def normalize(args):
+    return normalizer.terms(' '.join(args))
 
-cur.execute('drop view if exists query')
+def parse(args):
+    """Split a query into plain terms, (field, term) pairs and
+    quoted phrases."""
+    text = ' '.join(args)
+    phrases = [terms for terms in map(normalizer.terms, quoted.findall(text)) if terms]
+    terms, fielded = [], []
+    for word in quoted.sub(' ', text).split():
+        m = qualified.match(word)
+        if m:
+            fielded.extend((m.group(1).lower(), term) for term in normalizer.terms(m.group(2)))
+        else:
+            terms.extend(normalizer.terms(word))
+    return terms, fielded, phrases
 
-sql = ['create view query as select * from matrix']
-for term in sorted(counts.keys()):
-    sql.append('select "q" as id, "{}" as term, {} as value'.format(term, counts[term]))
+def words(terms, fielded, phrases):
+    return (terms + ['{}:{}'.format(field, term) for field, term in fielded] +
+            ['"{}"'.format(' '.join(terms)) for terms in phrases])
 
-cur.execute(' union '.join(sql))
-sql = 'select q.score, s.artist, s.title, s.filename from song s join (select b.id as id, sum(a.value*b.value) as score from query a join query b on a.term = b.term where a.id = "q" group by b.id order by score desc limit 20) as q on s.id = q.id order by score desc, artist asc, title asc'
+def plain(terms, phrases):
+    return terms + [term for terms in phrases for term in terms]
 
-rows = list(cur.execute(sql))
-if not rows:
-    print('No songs matching your query were found.')
-else:
-    print('Found {} songs matching your query. You may refine your search to narrow your results.'.format(len(rows)))
-    for row in rows:
-        score, artist, title, filename = row
-        print(artist, '-', title)
-        print('  ', filename)
+def score(ranking, postings, counts, limit=LIMIT, field_postings=None, fielded=None, rerank=None):
+    if fielded:
+        scores = accumulate(ranking, postings, counts, intersect(ranking, field_postings, fielded, BOOSTS))
+    else:
+        scores = accumulate(ranking, postings, counts)
+    if rerank:
+        scores = rerank(scores)
+    return topk(scores, limit)
+
+def rank(best, songs):
+    rows = [(score,) + songs[id] for id, score in best if id in songs]
+    return sorted(rows, key=lambda row: (-row[0], row[1], row[2]))
+
+def connect(path='songs.db'):
+    return sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(path)), uri=True)
+
+def ranking(conn, name=RANKING):
+    stats = dict(conn.execute('select key, value from stats'))
+    return RANKINGS[name](stats.get('songs', 0), stats.get('length', 0))
+
+def postings(conn, term):
+    row = conn.execute('select df from vocabulary where term = ?', (term,)).fetchone()
+    if row is None:
+        return 0, ()
+    return row[0], conn.execute('select m.id, m.value, s.length from matrix m join song s on s.id = m.id where m.term = ?', (term,))
+
+def field_postings(conn, field, term):
+    rows = conn.execute('select f.id, f.value, s.length from field f join song s on s.id = f.id where f.field = ? and f.term = ?',
+                        (field, term)).fetchall()
+    return len(rows), rows
+
+def ids_of(conn, term):
+    return {id for id, in conn.execute('select id from matrix where term = ?', (term,))}
+
+def positions_of(conn, id, term):
+    row = conn.execute('select positions from matrix where id = ? and term = ?', (id, term)).fetchone()
+    return codec.decode(row[0]) if row else []
+
+def songs_of(conn, best):
+    songs = {}
+    for id, _ in best:
+        for row in conn.execute('select artist, title, filename from song where id = ?', (id,)):
+            songs[id] = row
+    return songs
+
+def lookup(conn, ranker, counts, limit=LIMIT, fielded=None, phrases=()):
+    def rerank(scores):
+        return phrase.apply(scores, list(counts), phrases,
+                            lambda term: ids_of(conn, term), lambda id, term: positions_of(conn, id, term))
+    best = score(ranker, lambda term: postings(conn, term), counts, limit,
+                 lambda field, term: field_postings(conn, field, term), fielded, rerank)
+    return rank(best, songs_of(conn, best))
+
+def search(conn, counts, limit=LIMIT, rank_by=RANKING, fielded=None, phrases=()):
+    return lookup(conn, ranking(conn, rank_by), counts, limit, fielded, phrases)
+
+
+class Searcher:
+    """Searches songs.db over one connection kept open across
+    searches."""
+
+    def __init__(self, path='songs.db', rank_by=RANKING, expand=False):
+        self.conn = connect(path)
+        self.rank_by = rank_by
+        self.expand = expand
+        self.generation = None
+
+    def ranking(self):
+        row = self.conn.execute("select value from stats where key = 'generation'").fetchone()
+        generation = row[0] if row else 0
+        if generation != self.generation:
+            self.ranker, self.generation = ranking(self.conn, self.rank_by), generation
+        return self.ranker
+
+    def search(self, query, k=LIMIT):
+        """The k best songs for query, a string or a list of words,
+        as (score, artist, title, filename) rows."""
+        terms, fielded, phrases = parse([query] if isinstance(query, str) else query)
+        if self.expand:
+            terms = fuzzy.expand_all(self.conn, terms)
+        return lookup(self.conn, self.ranking(), count(plain(terms, phrases)), k, count(fielded), phrases)
+
+
+worker = None
+
+def start_worker(rank_by, expand):
+    global worker
+    worker = Searcher(rank_by=rank_by, expand=expand)
+
+def lookup_line(args):
+    line, limit = args
+    return line, worker.search(line, limit)
+
+def batch(lines, limit=LIMIT, rank_by=RANKING, jobs=1, expand=False):
+    items = ((line, limit) for line in lines)
+    if jobs > 1:
+        with multiprocessing.Pool(jobs, start_worker, (rank_by, expand)) as pool:
+            yield from pool.imap(lookup_line, items, chunksize=64)
+    else:
+        start_worker(rank_by, expand)
+        yield from map(lookup_line, items)
+
+def remote(q, limit=LIMIT, rank_by=RANKING):
+    params = [('q', term) for term in q] + [('limit', limit), ('rank', rank_by)]
+    url = '{}/search?{}'.format(SERVER, urllib.parse.urlencode(params))
+    try:
+        with urllib.request.urlopen(url, timeout=TIMEOUT) as res:
+            return [tuple(row) for row in json.load(res)]
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search for a song in songs.db.')
+    parser.add_argument('--rank', choices=sorted(RANKINGS), default=RANKING)
+    parser.add_argument('--sparse', action='store_true', help='score against songs.npz')
+    parser.add_argument('--compact', action='store_true', help='score against songs.idx')
+    parser.add_argument('--fuzzy', action='store_true', help='match misspelled terms')
+    parser.add_argument('--batch', nargs='?', const='-', metavar='FILE',
+                        help='read queries from FILE (default stdin), write JSON lines')
+    parser.add_argument('--limit', type=int, default=LIMIT)
+    parser.add_argument('--jobs', type=int, default=1, help='worker processes for --batch')
+    parser.add_argument('query', nargs='*')
+    args = parser.parse_args()
+
+    if args.batch is not None:
+        f = sys.stdin if args.batch == '-' else open(args.batch, encoding='utf-8')
+        with f:
+            lines = (line.strip() for line in f)
+            for line, rows in batch((line for line in lines if line), args.limit, args.rank, args.jobs, args.fuzzy):
+                results = [dict(zip(('score', 'artist', 'title', 'filename'), row)) for row in rows]
+                print(json.dumps({'query': line, 'results': results}, ensure_ascii=False))
+        exit()
+
+    if not args.query:
+        parser.error('a query or --batch is required')
+
+    terms, fielded, phrases = parse(args.query)
+    if (args.sparse or args.compact) and (fielded or phrases):
+        parser.error('--sparse and --compact do not support field:term or quoted phrases')
+    if args.fuzzy:
+        terms = fuzzy.expand_all(connect(), terms)
+
+    if args.sparse:
+        from sparse import SparseIndex
+        index = SparseIndex()
+        if index.rank != args.rank:
+            parser.error('songs.npz is weighted by {}, export it again with --rank {}'.format(index.rank, args.rank))
+        conn = connect()
+        best = index.search(count(plain(terms, phrases)), args.limit)
+        rows = rank(best, songs_of(conn, best))
+    elif args.compact:
+        from compact import CompactIndex
+        conn = connect()
+        best = CompactIndex().search(count(plain(terms, phrases)), args.limit, args.rank)
+        rows = rank(best, songs_of(conn, best))
+    else:
+        rows = remote(words(terms, fielded, phrases), args.limit, args.rank)
+    if rows is None:
+        rows = Searcher(rank_by=args.rank).search(words(terms, fielded, phrases), args.limit)
+
+    if not rows:
+        print('No songs matching your query were found.')
+    else:
+        print('Found {} songs matching your query. You may refine your search to narrow your results.'.format(len(rows)))
+        for row in rows:
+            score, artist, title, filename = row
+            print(artist, '-', title)
+            print('  ', filename)
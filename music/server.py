@@ -0,0 +1,160 @@
+# server.py
+# Resident search server for the song catalogue in songs.db.
+#
+# Opens songs.db once and keeps the term dictionary, posting
+# lists and song metadata in memory, so a query is a handful of
+# dict lookups. The per-field postings for qualified terms
+# (artist:queen) are held in memory as well, and so are the
+# encoded term positions for phrases and proximity, which are
+# only decoded for the songs being reranked. index.py bumps
+# the generation in the stats table on every update, and the
+# index is reloaded whenever it changes, in one read transaction
+# so that it sees a single snapshot of the database.
+#
+# The results of the last CACHE queries are kept, keyed on their
+# normalized terms, fields and phrases (so "Queen queen" and
+# "queen QUEEN" share an entry) and on limit and ranking. The
+# cache is emptied when the index is reloaded.
+#
+# Usage: server.py [port]
+#   GET /search?q=term&q=term[&limit=n][&rank=bm25] -> JSON list of
+#   [score, artist, title, filename]
+#   GET /complete?q=partial query[&limit=n] -> JSON list of
+#   [completed query, songs with term, [best songs]]
+
+import json, sys, urllib.parse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from complete import COMPLETIONS, Completer, suggest
+from ranking import RANKINGS
+import phrase
+import codec
+from search import LIMIT, RANKING, connect, count, parse, plain, rank, score
+
+CACHE = 1024
+PORT = 8017
+
+
+class Catalogue:
+    def __init__(self, path='songs.db'):
+        self.conn = connect(path)
+        self.generation = None
+        self.cache = OrderedDict()
+        self.reload()
+
+    def reload(self):
+        self.conn.execute('begin')
+        try:
+            self.load()
+        finally:
+            self.conn.execute('commit')
+
+    def load(self):
+        row = self.conn.execute("select value from stats where key = 'generation'").fetchone()
+        generation = row[0] if row else 0
+        if generation == self.generation:
+            return
+        songs, lengths = {}, {}
+        for id, artist, title, filename, length in self.conn.execute('select id, artist, title, filename, length from song'):
+            songs[id] = (artist, title, filename)
+            lengths[id] = length
+        postings = {}
+        for id, term, value in self.conn.execute('select id, term, value from matrix'):
+            postings.setdefault(term, []).append((id, value, lengths[id]))
+        positions = {(id, term): encoded for id, term, encoded in self.conn.execute('select id, term, positions from matrix')}
+        fields = {}
+        for field, term, id, value in self.conn.execute('select field, term, id, value from field'):
+            fields.setdefault((field, term), []).append((id, value, lengths[id]))
+        self.fields = fields
+        terms = sorted(postings)
+        self.completer = Completer(terms, [len(postings[term]) for term in terms])
+        self.postings, self.positions, self.songs, self.generation = postings, positions, songs, generation
+        self.length = sum(lengths.values())
+        self.cache.clear()
+        print('Loaded {} songs, {} terms.'.format(len(songs), len(postings)))
+
+    def postings_of(self, term):
+        rows = self.postings.get(term, ())
+        return len(rows), rows
+
+    def ids_of(self, term):
+        return {id for id, value, length in self.postings.get(term, ())}
+
+    def positions_of(self, id, term):
+        encoded = self.positions.get((id, term))
+        return codec.decode(encoded) if encoded else []
+
+    def fields_of(self, field, term):
+        rows = self.fields.get((field, term), ())
+        return len(rows), rows
+
+    def search(self, q, limit=LIMIT, rank_by=RANKING):
+        self.reload()
+        terms, fielded, phrases = parse(q)
+        counts = count(plain(terms, phrases))
+        fielded = count(fielded)
+        key = (frozenset(counts.items()), frozenset(fielded.items()), frozenset(map(tuple, phrases)), limit, rank_by)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        ranking = RANKINGS[rank_by](len(self.songs), self.length)
+        def rerank(scores):
+            return phrase.apply(scores, list(counts), phrases, self.ids_of, self.positions_of)
+        rows = rank(score(ranking, self.postings_of, counts, limit, self.fields_of, fielded, rerank), self.songs)
+        self.cache[key] = rows
+        if len(self.cache) > CACHE:
+            self.cache.popitem(last=False)
+        return rows
+
+    def complete(self, text, limit=COMPLETIONS):
+        self.reload()
+        return suggest(self.completer, self.search, text, limit)
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        catalogue = self.server.catalogue
+        if url.path == '/search':
+            limit = self.param(params, 'limit', LIMIT)
+            rank_by = params.get('rank', [RANKING])[0]
+            if limit is None:
+                return
+            if rank_by not in RANKINGS:
+                self.send_error(400, 'Bad rank')
+                return
+            self.send_json(catalogue.search(params.get('q', []), limit, rank_by))
+        elif url.path == '/complete':
+            limit = self.param(params, 'limit', COMPLETIONS)
+            if limit is not None:
+                self.send_json(catalogue.complete(' '.join(params.get('q', [])), limit))
+        else:
+            self.send_error(404)
+
+    def param(self, params, name, default):
+        try:
+            return int(params.get(name, [default])[0])
+        except ValueError:
+            self.send_error(400, 'Bad ' + name)
+            return None
+
+    def send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+    server = HTTPServer(('127.0.0.1', port), SearchHandler)
+    server.catalogue = Catalogue()
+    print('Serving songs.db on port', port)
+    server.serve_forever()
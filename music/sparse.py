@@ -0,0 +1,109 @@
+# sparse.py
+# In-memory sparse matrix backend for the song search.
+# Requires numpy and scipy.
+#
+# Usage: sparse.py export [--rank bm25|tfidf|count]
+#        sparse.py playlist <file> [--limit n]
+#
+# export writes the document term matrix in songs.db to songs.npz
+# as a compressed sparse row matrix (songs x vocabulary). The
+# entries are already weighted by the chosen ranking, so scoring
+# a query is one sparse product with its term counts, and the
+# top k songs are picked with argpartition. playlist matches every
+# "artist - title" line of a file at once as a sparse
+# matrix-matrix product.
+
+import argparse
+
+import numpy as np
+import scipy.sparse
+
+from search import LIMIT, RANKING, connect, count, normalize, ranking, songs_of
+from ranking import RANKINGS
+
+NPZ = 'songs.npz'
+
+def export(conn, path=NPZ, rank_by=RANKING):
+    weigh = ranking(conn, rank_by).weight
+    ids = [id for id, in conn.execute('select id from song order by id')]
+    rows = {id: i for i, id in enumerate(ids)}
+    terms, df = [], {}
+    for term, n in conn.execute('select term, df from vocabulary order by term'):
+        terms.append(term)
+        df[term] = n
+    cols = {term: j for j, term in enumerate(terms)}
+    lengths = dict(conn.execute('select id, length from song'))
+    r, c, v = [], [], []
+    for id, term, value in conn.execute('select id, term, value from matrix'):
+        r.append(rows[id])
+        c.append(cols[term])
+        v.append(weigh(value, df[term], lengths[id], 1))
+    m = scipy.sparse.csr_matrix((np.array(v, dtype=np.float32), (r, c)), shape=(len(ids), len(terms)))
+    np.savez_compressed(path, data=m.data, indices=m.indices, indptr=m.indptr, shape=m.shape,
+                        ids=np.array(ids), terms=np.array(terms), rank=rank_by)
+    return m
+
+
+class SparseIndex:
+    def __init__(self, path=NPZ):
+        with np.load(path) as f:
+            self.matrix = scipy.sparse.csr_matrix((f['data'], f['indices'], f['indptr']),
+                                                  shape=tuple(f['shape']))
+            self.ids = f['ids'].tolist()
+            self.terms = {term: j for j, term in enumerate(f['terms'].tolist())}
+            self.rank = str(f['rank'])
+
+    def vectors(self, queries):
+        r, c, v = [], [], []
+        for i, counts in enumerate(queries):
+            for term, n in counts.items():
+                if term in self.terms:
+                    r.append(i)
+                    c.append(self.terms[term])
+                    v.append(n)
+        return scipy.sparse.csr_matrix((np.array(v, dtype=np.float32), (r, c)),
+                                       shape=(len(queries), len(self.terms)))
+
+    def search(self, counts, limit=LIMIT):
+        return self.search_many([counts], limit)[0]
+
+    def search_many(self, queries, limit=LIMIT):
+        scores = (self.matrix @ self.vectors(queries).T).tocsc()
+        results = []
+        for j in range(scores.shape[1]):
+            start, end = scores.indptr[j], scores.indptr[j + 1]
+            rows, data = scores.indices[start:end], scores.data[start:end]
+            top = np.argpartition(-data, limit)[:limit] if len(data) > limit else np.arange(len(data))
+            top = top[np.argsort(-data[top], kind='stable')]
+            results.append([(self.ids[rows[i]], float(data[i])) for i in top])
+        return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sparse matrix backend for songs.db.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('export', help='write songs.npz from songs.db')
+    command.add_argument('--rank', choices=sorted(RANKINGS), default=RANKING)
+    command = commands.add_parser('playlist', help='match every line of a playlist file')
+    command.add_argument('file')
+    command.add_argument('--limit', type=int, default=1)
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.command == 'export':
+        m = export(conn, rank_by=args.rank)
+        print('Exported {} songs x {} terms ({} entries) to {}.'.format(m.shape[0], m.shape[1], m.nnz, NPZ))
+    else:
+        with open(args.file, encoding='utf-8') as f:
+            lines = [line.strip() for line in f if line.strip()]
+        index = SparseIndex()
+        for line, best in zip(lines, index.search_many([count(normalize(line.split())) for line in lines], args.limit)):
+            print(line)
+            songs = songs_of(conn, best)
+            if not best:
+                print('   (no match)')
+            for id, score in best:
+                if id in songs:
+                    artist, title, filename = songs[id]
+                    print('   {:.3f} {} - {}'.format(score, artist, title))
+                    print('     ', filename)
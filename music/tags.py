@@ -0,0 +1,44 @@
+# tags.py
+# Metadata of a song file for index.py.
+#
+# Embedded tags (ID3 and whatever else mutagen understands) are
+# read with mutagen if it is installed. Whatever the tags leave
+# out is taken from the "Artist - Title [..]" filename.
+
+import os, re
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None
+
+FIELDS = ('artist', 'title', 'album', 'duration')
+
+def clean(s):
+    return ' '.join(s.split())
+
+def read(fn):
+    """The tags of fn, empty for the ones it does not have."""
+    tags = {'artist': '', 'title': '', 'album': '', 'duration': None}
+    if mutagen is None:
+        return tags
+    try:
+        f = mutagen.File(fn, easy=True)
+    except (mutagen.MutagenError, OSError):
+        return tags
+    if f is None:
+        return tags
+    for key in ('artist', 'title', 'album'):
+        values = f.tags.get(key) if f.tags else None
+        if values:
+            tags[key] = clean(values[0])
+    if f.info is not None:
+        tags['duration'] = f.info.length
+    return tags
+
+def from_filename(fn):
+    noext = os.path.splitext(os.path.basename(fn))[0]
+    m = re.match(r'(.*?)-\s*(.*?)\s*(?:\[|$)', noext)
+    if m is None:
+        return '', clean(noext)
+    return clean(m.group(1)), clean(m.group(2))